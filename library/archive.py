@@ -34,11 +34,13 @@ options:
     description:
       - If remote_src=no (default), local path to archive file to copy to the target server; can be absolute or relative. If remote_src=yes, path on the target server to existing archive file to unpack.
       - If remote_src=yes and src contains ://, the remote machine will download the file from the url first. (version_added 2.0)
+      - Can be a list of directories, each is packed to the matching entry of I(dest) in parallel.
     required: true
     default: null
   dest:
     description:
       - Remote absolute path where the archive should be unpacked
+      - Must be a list of the same length when I(src) is a list.
     required: true
     default: null
   copy:
@@ -104,9 +106,11 @@ todo:
 notes:
     - requires C(gtar)/C(unzip) command on target host
     - can handle I(gzip), I(bzip2) and I(xz) compressed as well as uncompressed tar files
+    - compresses with C(zstd) instead of I(gzip) when I(options) contains C(zst), this requires
+      the C(zstd) command on the target host
     - detects type of archive automatically
-    - uses gtar's C(--diff arg) to calculate if changed or not. If this C(arg) is not
-      supported, it will always unpack the archive
+    - compares the members of an existing archive with the files on disk to
+      calculate if changed or not, using C(pigz) to decompress when it is installed
     - existing files/directories in the destination which are not in the archive
       are not touched.  This is the same behavior as a normal archive extraction
     - existing files/directories in the destination which are not in the archive
@@ -116,28 +120,38 @@ notes:
 EXAMPLES = '''
 # Example from Ansible Playbooks
 - archive: src=/var/lib/foo dest=foo.tgz
+
+# Pack several directories in parallel
+- archive:
+    src: [ /var/lib/foo, /var/lib/bar ]
+    dest: [ foo.tgz, bar.tgz ]
 '''
 
 import re
 import os
 import stat
-import pwd
-import grp
-import datetime
-import time
-import binascii
-import codecs
+import tarfile
+import tempfile
+import traceback
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from subprocess import Popen, PIPE
 from zipfile import ZipFile, BadZipfile
 
-# String from tar that shows the tar contents are different from the
-# filesystem
-OWNER_DIFF_RE = re.compile(r': Uid differs$')
-GROUP_DIFF_RE = re.compile(r': Gid differs$')
-MODE_DIFF_RE = re.compile(r': Mode differs$')
-MOD_TIME_DIFF_RE = re.compile(r': Mod time differs$')
-#NEWER_DIFF_RE = re.compile(r' is newer or same age.$')
-MISSING_FILE_RE = re.compile(r': Warning: Cannot stat: No such file or directory$')
 ZIP_FILE_MODE_RE = re.compile(r'([r-][w-][stx-]){3}')
+OCTAL_MODE_RE = re.compile(r'^[0-7]+$')
+# Characters that make an exclude a pattern rather than a literal path
+GLOB_CHARS_RE = re.compile(r'[*?[\\]')
+
+# Parallel compressors to use instead of gtar's own, keyed by gtar's
+# compression flag. They must use every core by default and accept -dc
+# to decompress to stdout, which rules out pixz for a future xz handler
+PARALLEL_COMPRESSORS = dict(z='pigz')
+
+C_LOCALE_ENV = dict(LANG='C', LC_ALL='C', LC_MESSAGES='C', LC_CTYPE='C')
+
+# Paths found by cached_bin_path(), None when a command is not installed
+BIN_CACHE = {}
 
 class ArchiveError(Exception):
     pass
@@ -145,20 +159,27 @@ class ArchiveError(Exception):
 # class to handle gzipped tar files
 class TgzArchive(object):
 
-    def __init__(self, src, dest, file_args, module):
+    def __init__(self, src, dest, file_args, options, module):
         self.src = src
         self.dest = dest
         self.file_args = file_args
+        self.options = options
         self.opts = module.params['extra_opts']
         self.module = module
         self.excludes = [ path.rstrip('/') for path in self.module.params['exclude']]
+        self._exclude_args = ['--exclude=' + path for path in self.excludes]
+        self._exclude_globs = [path for path in self.excludes if GLOB_CHARS_RE.search(path)]
+        self._exclude_set = set(path for path in self.excludes if not GLOB_CHARS_RE.search(path))
         # Prefer gtar (GNU tar) as it supports the compression options -zjJ
-        self.cmd_path = self.module.get_bin_path('gtar', None)
+        self.cmd_path = cached_bin_path(self.module, 'gtar')
         if not self.cmd_path:
             # Fallback to tar
-            self.cmd_path = self.module.get_bin_path('tar')
+            self.cmd_path = cached_bin_path(self.module, 'tar')
         self.zipflag = 'z'
         self.compress_mode = 'gz'
+        # Use a parallel compressor if one is installed, gtar's own is single-threaded
+        self.compress_program = cached_bin_path(self.module, PARALLEL_COMPRESSORS[self.zipflag])
+        self.compress_args = []
         self._files_in_archive = []
 
 #     @property
@@ -176,6 +197,7 @@ class TgzArchive(object):
 #         if rc != 0:
 #             raise ArchiveError('Unable to list files in the archive')
 
+#         import codecs
 #         for filename in out.splitlines():
 #             # Compensate for locale-related problems in gtar output (octal unicode representation) #11348
 # #            filename = filename.decode('string_escape')
@@ -185,79 +207,313 @@ class TgzArchive(object):
 #         return self._files_in_archive
 
     def is_archived(self):
-        cmd = '%s -c%s' % (self.cmd_path, self.zipflag)
+        # Compare the members of the existing archive with what is on disk,
+        # decompressing with the parallel compressor when there is one
         if self.opts:
-            cmd += ' ' + ' '.join(self.opts)
-        if self.file_args['owner']:
-            cmd += ' --owner="%s"' % self.file_args['owner']
-        if self.file_args['group']:
-            cmd += ' --group="%s"' % self.file_args['group']
-        if self.file_args['mode']:
-            cmd += ' --mode="%s"' % self.file_args['mode']
-        if self.excludes:
-            cmd += ' --exclude="' + '" --exclude="'.join(self.excludes) + '"'
-        cmd += ' -f "%s"' % self.src
-        rc, out, err = self.module.run_command(cmd)
-
-        # Check whether the differences are in something that we're
-        # setting anyway
-
-        # What is different
+            # What extra_opts do to the archive cannot be checked
+            return dict(archived=False, out='extra_opts given, not checking the existing archive\n')
+        if self._exclude_globs:
+            # Only gtar knows exactly what its wildcards match
+            return dict(archived=False, out='wildcard excludes given, not checking the existing archive\n')
+
         archived = True
-        old_out = out
         out = ''
         run_uid = os.getuid()
-        # When archiving as a user, or when owner/group/mode is supplied --diff is insufficient
-        # Only way to be sure is to check request with what is on disk (as we do for zip)
-        # Leave this up to set_fs_attributes_if_different() instead of inducing a (false) change
-        for line in old_out.splitlines() + err.splitlines():
-            if run_uid == 0 and not self.file_args['owner'] and OWNER_DIFF_RE.search(line):
-                out += line + '\n'
-            if run_uid == 0 and not self.file_args['group'] and GROUP_DIFF_RE.search(line):
-                out += line + '\n'
-            if not self.file_args['mode'] and MODE_DIFF_RE.search(line):
-                out += line + '\n'
-            if MOD_TIME_DIFF_RE.search(line):
-                out += line + '\n'
-            if MISSING_FILE_RE.search(line):
-                out += line + '\n'
-        if out:
+        archive_file = None
+        devnull = None
+        proc = None
+        names = set()
+        try:
+            archive_file = open(self.dest, 'rb')
+            # The archive is read front to back once, let the kernel read ahead.
+            # The compressor inherits the open file, so the hint applies to it too
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(archive_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            if self.compress_program:
+                # Nothing reads its stderr, a pipe could fill up and stall it
+                devnull = open(os.devnull, 'wb')
+                proc = Popen([self.compress_program, '-dc'], stdin=archive_file, stdout=PIPE, stderr=devnull)
+                archive = tarfile.open(fileobj=proc.stdout, mode='r|')
+            else:
+                archive = tarfile.open(fileobj=archive_file, mode='r|' + self.compress_mode)
+            for member in archive:
+                diff = self._member_diff(member, run_uid)
+                if diff:
+                    # One difference is enough, no need to read the rest
+                    archived = False
+                    out = '%s: %s\n' % (member.name, diff)
+                    break
+                names.add(member.name)
+            archive.close()
+            if archived:
+                # Files added to src since the archive was made
+                walk_errors = []
+                for path in self._walk(walk_errors):
+                    if path.lstrip('/') not in names:
+                        # tar ignores sockets, so they are never in the archive
+                        if stat.S_ISSOCK(os.lstat(path).st_mode):
+                            continue
+                        archived = False
+                        out = '%s: Not in archive\n' % path
+                        break
+                if walk_errors:
+                    archived = False
+                    out = '%s\n' % walk_errors[0]
+        except (IOError, OSError, tarfile.TarError) as e:
             archived = False
-        return dict(archived=archived, rc=rc, out=out, err=err, cmd=cmd)
+            out = '%s: %s\n' % (self.dest, e)
+        finally:
+            if proc:
+                if proc.poll() is None:
+                    proc.terminate()
+                proc.wait()
+            if archive_file:
+                archive_file.close()
+            if devnull:
+                devnull.close()
+        return dict(archived=archived, out=out)
+
+    def _member_diff(self, member, run_uid):
+        # tar strips the leading / from the absolute source path
+        path = os.path.join(os.sep, member.name)
+        if self._is_excluded(path):
+            return 'Excluded'
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return 'No such file or directory'
+
+        # When owner/group/mode is supplied the archive should carry it
+        # rather than what is on disk
+        owner, group, mode = self.file_args['owner'], self.file_args['group'], self.file_args['mode']
+        if owner and owner not in (member.uname, str(member.uid)):
+            return 'Owner differs'
+        if group and group not in (member.gname, str(member.gid)):
+            return 'Group differs'
+        if mode is not None and member.mode != self._requested_mode():
+            return 'Mode differs'
+
+        # When archiving as a user --diff is insufficient
+        # Leave this up to set_fs_attributes_if_different() instead of inducing a (false) change
+        if run_uid == 0 and not owner and st.st_uid != member.uid:
+            return 'Uid differs'
+        if run_uid == 0 and not group and st.st_gid != member.gid:
+            return 'Gid differs'
+        if mode is None and stat.S_IMODE(st.st_mode) != member.mode:
+            return 'Mode differs'
+        if not member.isdir() and int(st.st_mtime) != member.mtime:
+            return 'Mod time differs'
+        return None
+
+    def _requested_mode(self):
+        # The mode as an int, None for a symbolic mode whose result depends
+        # on each file's own mode
+        mode = self.file_args['mode']
+        if isinstance(mode, int):
+            return mode
+        if OCTAL_MODE_RE.match(mode):
+            return int(mode, 8)
+        return None
 
     def archive(self):
-        cmd = '%s -c%s' % (self.cmd_path, self.zipflag)
-        if self.opts:
-            cmd += ' ' + ' '.join(self.opts)
+        if self.compress_program:
+            cmd = [self.cmd_path, '-c']
+        else:
+            cmd = [self.cmd_path, '-c' + self.zipflag]
+        cmd.extend(self.opts)
         if self.file_args['owner']:
-            cmd += ' --owner="%s"' % self.file_args['owner']
+            cmd.append('--owner=%s' % self.file_args['owner'])
         if self.file_args['group']:
-            cmd += ' --group="%s"' % self.file_args['group']
-        if self.file_args['mode']:
-            cmd += ' --mode="%s"' % self.file_args['mode']
-        if self.excludes:
-            cmd += ' --exclude="' + '" --exclude="'.join(self.excludes) + '"'
-        cmd += ' -f "%s" "%s"' % (self.dest, self.src)
-        rc, out, err = self.module.run_command(cmd, cwd=self.dest)
-        return dict(cmd=cmd, rc=rc, out=out, err=err)
+            cmd.append('--group=%s' % self.file_args['group'])
+        if isinstance(self.file_args['mode'], int):
+            cmd.append('--mode=%04o' % self.file_args['mode'])
+        elif self.file_args['mode']:
+            cmd.append('--mode=%s' % self.file_args['mode'])
+        file_list = None
+        walk_errors = []
+        # Literal excludes are applied while walking src ourselves, which spares
+        # gtar from matching every member against every pattern
+        if self._exclude_globs or not self._exclude_set:
+            cmd.extend(self._exclude_args)
+            members = [self.src]
+        else:
+            file_list = self._list_files(walk_errors)
+            members = ['--no-recursion', '--null', '-T', file_list.name]
+        try:
+            if walk_errors:
+                # gtar would have reported these and failed, so fail the same way
+                err = ''.join('%s\n' % e for e in walk_errors)
+                return dict(cmd=cmd + members, rc=2, out='', err=err)
+            if self.compress_program:
+                return self._archive_through_compressor(cmd + ['-f', '-'] + members)
+            cmd.extend(['-f', self.dest] + members)
+            proc = Popen(cmd, stdout=PIPE, stderr=PIPE, env=self._env())
+            out, err = proc.communicate()
+            return dict(cmd=cmd, rc=proc.returncode, out=out.decode('utf-8', 'replace'), err=err.decode('utf-8', 'replace'))
+        finally:
+            if file_list:
+                file_list.close()
+
+    def _list_files(self, errors):
+        # Write every path under src that is not excluded to a temporary
+        # file, NUL separated, for gtar -T
+        file_list = tempfile.NamedTemporaryFile()
+        for path in self._walk(errors):
+            file_list.write(to_bytes(path, errors='surrogate_or_strict') + b'\0')
+        file_list.flush()
+        return file_list
+
+    def _walk(self, errors):
+        # Yield every path gtar would archive from src, minus the excludes.
+        # Directories that cannot be read are added to errors
+        if self._is_excluded(self.src):
+            return
+        for root, dirs, files in os.walk(self.src, onerror=errors.append):
+            yield root
+            # Pruning dirs keeps os.walk out of excluded directories
+            dirs[:] = [d for d in dirs if not self._is_excluded(os.path.join(root, d))]
+            for name in dirs:
+                path = os.path.join(root, name)
+                # os.walk does not descend into symlinks, so list them here
+                if os.path.islink(path):
+                    yield path
+            for name in files:
+                path = os.path.join(root, name)
+                if not self._is_excluded(path):
+                    yield path
+
+    def _is_excluded(self, path):
+        # Same as gtar's default unanchored matching: an exclude matches the
+        # member name or any trailing part of it that starts after a /, so an
+        # absolute exclude can only match the whole name
+        name = path
+        while True:
+            if name in self._exclude_set:
+                return True
+            pos = name.find('/')
+            if pos == -1:
+                return False
+            name = name[pos + 1:]
+
+    def _archive_through_compressor(self, cmd):
+        # Pipe tar straight into the compressor, which writes dest itself
+        env = self._env()
+        dest = open(self.dest, 'wb')
+        # The compressor's stderr goes to a file: it is only read once tar is
+        # done, and a full pipe would stall the compressor and tar with it
+        compress_err = tempfile.TemporaryFile()
+        try:
+            tar = Popen(cmd, stdout=PIPE, stderr=PIPE, env=env)
+            compress = Popen([self.compress_program] + self.compress_args, stdin=tar.stdout, stdout=dest, stderr=compress_err, env=env)
+            # Only the compressor should hold the read end of the pipe
+            tar.stdout.close()
+            err = tar.stderr.read()
+            tar_rc = tar.wait()
+            compress_rc = compress.wait()
+            rc = tar_rc or compress_rc
+            compress_err.seek(0)
+            err += compress_err.read()
+        finally:
+            compress_err.close()
+            dest.close()
+        return dict(cmd=cmd + ['|', self.compress_program] + self.compress_args, rc=rc, out='', err=err.decode('utf-8', 'replace'))
+
+    def _env(self):
+        # tar is started with Popen rather than run_command, which swaps
+        # os.environ around each call and so is not safe on worker threads
+        env = dict(os.environ)
+        env.update(self.module.run_command_environ_update)
+        return env
 
     def can_handle_archive(self):
         if not self.cmd_path:
             return False
 
-        if 'z' in self.options:
+        # 'zst' also contains a 'z' but is left to ZstdArchive
+        if 'z' in self.options and 'zst' not in self.options:
             return True
-        
+
         # Errors and no files in archive assume that we weren't able to
         # properly unarchive it
         return False
 
 
+# class to handle zstd compressed tar files
+class ZstdArchive(TgzArchive):
+
+    def __init__(self, src, dest, file_args, options, module):
+        super(ZstdArchive, self).__init__(src, dest, file_args, options, module)
+        self.compress_mode = 'zst'
+        # zstd is multi-threaded itself, -T0 uses every core
+        self.compress_program = cached_bin_path(self.module, 'zstd')
+        self.compress_args = ['-T0']
+
+    def can_handle_archive(self):
+        # tarfile cannot read zstd, so the command is required
+        if not self.cmd_path or not self.compress_program:
+            return False
+
+        return 'zst' in self.options
+
+
+def cached_bin_path(module, name):
+    '''module.get_bin_path() that only searches the PATH once per command'''
+    if name not in BIN_CACHE:
+        BIN_CACHE[name] = module.get_bin_path(name, None)
+    return BIN_CACHE[name]
+
+
+def pack(handler):
+    '''Pack one archive and return its results, failures are flagged rather than raised'''
+    res_args = dict(handler=handler.__class__.__name__, dest=handler.dest, src=handler.src)
+
+    try:
+        # do we need to do pack?
+        res_args['check_results'] = handler.is_archived()
+        if res_args['check_results']['archived']:
+            res_args['changed'] = False
+            return res_args
+
+        # do the pack
+        res_args['extract_results'] = handler.archive()
+    except EnvironmentError as e:
+        res_args['failed'] = True
+        res_args['error'] = str(e)
+        return res_args
+    except (Exception, SystemExit) as e:
+        # ThreadPool.map() would re-raise an Exception but drop the other
+        # archives' results, and waits forever on a SystemExit from a stray
+        # fail_json(), so record them with their traceback instead
+        res_args['failed'] = True
+        res_args['error'] = str(e)
+        res_args['exception'] = traceback.format_exc()
+        return res_args
+
+    if res_args['extract_results']['rc'] != 0:
+        res_args['failed'] = True
+    else:
+        res_args['changed'] = True
+    return res_args
+
+
+def check_dir(module, path, name):
+    '''Fail unless path is a readable directory'''
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISDIR(st.st_mode):
+        module.fail_json(msg="%s '%s' does not exist" % (name, path))
+    # access() rather than the mode bits so ACLs are honoured
+    if not os.access(path, os.R_OK):
+        module.fail_json(msg="%s '%s' not readable" % (name, path))
+
+
 # try handlers in order and return the one that works or bail if none work
 def pick_handler(src, dest, file_args, options, module):
-    handlers = [TgzArchive]#, ZipArchive, TarArchive, TarBzipArchive, TarXzArchive]
+    handlers = [ZstdArchive, TgzArchive]#, ZipArchive, TarArchive, TarBzipArchive, TarXzArchive]
     for handler in handlers:
-        obj = handler(src, dest, file_args, module)
+        obj = handler(src, dest, file_args, options, module)
         if obj.can_handle_archive():
             return obj
     module.fail_json(msg='Failed to find handler for "%s". Make sure the required command to extract the file is installed.' % src)
@@ -267,8 +523,8 @@ def main():
     module = AnsibleModule(
         # not checking because of daisy chain to file module
         argument_spec = dict(
-            src                   = dict(required=True, type='path'),
-            dest                  = dict(required=True, type='path'),
+            src                   = dict(required=True, type='raw'),
+            dest                  = dict(required=True, type='raw'),
             options               = dict(required=True, type='str'),
             change_directory_path = dict(required=False, type='path'),
             exclude               = dict(required=False, default=[], type='list'),
@@ -281,45 +537,61 @@ def main():
     )
 
     # We screenscrape a huge amount of commands so use C locale anytime we do
-    module.run_command_environ_update = dict(LANG='C', LC_ALL='C', LC_MESSAGES='C', LC_CTYPE='C')
+    module.run_command_environ_update = C_LOCALE_ENV
 
-    src                   = os.path.expanduser(module.params['src'])
-    dest                  = os.path.expanduser(module.params['dest'])
+    srcs                  = module.params['src']
+    dests                 = module.params['dest']
     options               = module.params['options']
-    change_directory_path = os.path.expanduser(module.params['change_directory_path'])
-    file_args             = module.load_file_common_arguments(module.params)
+    change_directory_path = module.params['change_directory_path']
+
+    if not isinstance(srcs, list):
+        srcs = [srcs]
+    if not isinstance(dests, list):
+        dests = [dests]
+    if len(srcs) != len(dests):
+        module.fail_json(msg="src and dest must have the same number of entries")
+    # Expand like type='path' would and resolve once, everything after this
+    # works on absolute paths. src is resolved through symlinks so that a
+    # symlinked directory is archived with its contents, whether or not it
+    # was given with a trailing /
+    srcs = [os.path.realpath(os.path.expanduser(os.path.expandvars(src))) for src in srcs]
+    dests = [os.path.abspath(os.path.expanduser(os.path.expandvars(dest))) for dest in dests]
 
     # does the source exist?
-    if not os.path.isdir(src):
-        module.fail_json(msg="Source '%s' does not exist" % src)
-    if not os.access(src, os.R_OK):
-        module.fail_json(msg="Source '%s' not readable" % src)
+    for src in srcs:
+        check_dir(module, src, 'Source')
 
     # if the change directory path is specified, does it exist and is it accessible?
     if change_directory_path:
-        if not os.path.isdir(change_directory_path):
-            module.fail_json(msg="Change directory path '%s' does not exist" % change_directory_path)
-        if not os.access(change_directory_path, os.R_OK):
-            module.fail_json(msg="Change directory path '%s' not readable" % change_directory_path)
-    
-
-    handler = pick_handler(src, dest, file_args, options, module)
-    res_args = dict(handler=handler.__class__.__name__, dest=dest, src=src)
+        check_dir(module, change_directory_path, 'Change directory path')
 
-    # do we need to do pack?
-    check_results = handler.is_archived()
+    handlers = []
+    for src, dest in zip(srcs, dests):
+        # load_file_common_arguments() expects a single dest path
+        file_args = module.load_file_common_arguments(dict(module.params, dest=dest))
+        handlers.append(pick_handler(src, dest, file_args, options, module))
 
-    # do the unpack
-    try:
-        res_args['extract_results'] = handler.archive()
-        if res_args['extract_results']['rc'] != 0:
-            module.fail_json(msg="failed to pack %s to %s" % (src, dest), **res_args)
-    except IOError:
-        module.fail_json(msg="failed to pack %s to %s" % (src, dest), **res_args)
+    if len(handlers) == 1:
+        results = [pack(handlers[0])]
     else:
-        res_args['changed'] = True
-
-    module.exit_json(**res_args)
+        # The workers mostly wait on tar, so threads are enough
+        pool = ThreadPool(min(len(handlers), multiprocessing.cpu_count()))
+        try:
+            results = pool.map(pack, handlers)
+        finally:
+            pool.close()
+
+    failed = [res_args for res_args in results if res_args.get('failed')]
+    if len(results) == 1:
+        if failed:
+            module.fail_json(msg="failed to pack %s to %s" % (results[0]['src'], results[0]['dest']), **results[0])
+        module.exit_json(**results[0])
+
+    changed = any(res_args.get('changed') for res_args in results)
+    if failed:
+        module.fail_json(msg="failed to pack %s" % ', '.join('%s to %s' % (res_args['src'], res_args['dest']) for res_args in failed),
+                         changed=changed, results=results)
+    module.exit_json(changed=changed, results=results)
 
 
 # import module snippets
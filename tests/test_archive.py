@@ -0,0 +1,213 @@
+import grp
+import json
+import os
+import pwd
+import socket
+import shutil
+import subprocess
+import sys
+import tarfile
+
+import pytest
+
+pytest.importorskip('ansible')
+
+MODULE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'library', 'archive.py')
+
+
+def run_module(tmp_path, env=None, **args):
+    args_file = tmp_path / 'args.json'
+    args_file.write_text(json.dumps(dict(ANSIBLE_MODULE_ARGS=args)))
+    proc = subprocess.run([sys.executable, MODULE, str(args_file)], cwd=str(tmp_path), env=env, timeout=60,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert proc.stdout, proc.stderr
+    return json.loads(proc.stdout)
+
+
+@pytest.fixture
+def src(tmp_path):
+    src = tmp_path / 'src'
+    (src / 'sub').mkdir(parents=True)
+    (src / 'a.txt').write_text('a')
+    (src / 'sub' / 'b.txt').write_text('b')
+    return src
+
+
+def test_second_run_is_unchanged(tmp_path, src):
+    dest = str(tmp_path / 'out.tgz')
+    assert run_module(tmp_path, src=str(src), dest=dest, options='z')['changed']
+    result = run_module(tmp_path, src=str(src), dest=dest, options='z')
+    assert not result['changed']
+    assert 'extract_results' not in result
+
+
+def test_added_file_is_a_change(tmp_path, src):
+    dest = str(tmp_path / 'out.tgz')
+    run_module(tmp_path, src=str(src), dest=dest, options='z')
+    (src / 'sub' / 'c.txt').write_text('c')
+    assert run_module(tmp_path, src=str(src), dest=dest, options='z')['changed']
+
+
+def test_socket_is_not_a_change(tmp_path, src):
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+        sock.bind(str(src / 'sock'))
+        dest = str(tmp_path / 'out.tgz')
+        run_module(tmp_path, src=str(src), dest=dest, options='z')
+        assert not run_module(tmp_path, src=str(src), dest=dest, options='z')['changed']
+    finally:
+        sock.close()
+
+
+def test_new_exclude_is_a_change(tmp_path, src):
+    dest = str(tmp_path / 'out.tgz')
+    run_module(tmp_path, src=str(src), dest=dest, options='z')
+    assert run_module(tmp_path, src=str(src), dest=dest, options='z', exclude=['a.txt'])['changed']
+    assert not [name for name in archive_names(dest) if name.endswith('a.txt')]
+
+
+def nobody(name):
+    try:
+        if name == 'owner':
+            return pwd.getpwuid(65534).pw_name
+        return grp.getgrgid(65534).gr_name
+    except KeyError:
+        pytest.skip('no user or group 65534')
+
+
+@pytest.mark.parametrize('name', ['mode', 'owner', 'group'])
+def test_new_ownership_is_a_change(tmp_path, src, name):
+    args = {name: '0600' if name == 'mode' else nobody(name)}
+    dest = str(tmp_path / 'out.tgz')
+    run_module(tmp_path, src=str(src), dest=dest, options='z')
+    assert run_module(tmp_path, src=str(src), dest=dest, options='z', **args)['changed']
+    assert not run_module(tmp_path, src=str(src), dest=dest, options='z', **args)['changed']
+
+
+def test_extra_opts_always_pack(tmp_path, src):
+    dest = str(tmp_path / 'out.tgz')
+    run_module(tmp_path, src=str(src), dest=dest, options='z', extra_opts=['--exclude-vcs'])
+    assert run_module(tmp_path, src=str(src), dest=dest, options='z', extra_opts=['--exclude-vcs'])['changed']
+
+
+def test_list_of_sources(tmp_path, src):
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'c.txt').write_text('c')
+    dests = [str(tmp_path / 'src.tgz'), str(tmp_path / 'other.tgz')]
+    result = run_module(tmp_path, src=[str(src), str(other)], dest=dests, options='z')
+    assert result['changed'], result
+    assert [r['dest'] for r in result['results']] == dests
+    with tarfile.open(dests[1]) as archive:
+        assert archive.getnames()[-1].endswith('other/c.txt')
+
+
+def test_list_failure_reports_every_entry(tmp_path, src):
+    dests = [str(tmp_path / 'src.tgz'), str(tmp_path / 'missing' / 'src.tgz')]
+    result = run_module(tmp_path, src=[str(src), str(src)], dest=dests, options='z')
+    assert result['failed']
+    assert result['changed']
+    assert [r['dest'] for r in result['results']] == dests
+    assert [bool(r.get('failed')) for r in result['results']] == [False, True]
+
+
+def test_symlinked_source_keeps_contents(tmp_path, src):
+    (tmp_path / 'link').symlink_to(src)
+    dest = str(tmp_path / 'out.tgz')
+    run_module(tmp_path, src=str(tmp_path / 'link') + '/', dest=dest, options='z')
+    assert [name for name in archive_names(dest) if name.endswith('sub/b.txt')]
+    assert not run_module(tmp_path, src=str(tmp_path / 'link') + '/', dest=dest, options='z')['changed']
+
+
+def test_paths_expand_variables(tmp_path, src, monkeypatch):
+    monkeypatch.setenv('ARCHIVE_TEST_DIR', str(tmp_path))
+    result = run_module(tmp_path, src='$ARCHIVE_TEST_DIR/src', dest='$ARCHIVE_TEST_DIR/out.tgz', options='z')
+    assert result['changed'], result
+    assert os.path.exists(str(tmp_path / 'out.tgz'))
+
+
+def archive_names(path):
+    with tarfile.open(path) as archive:
+        return sorted(archive.getnames())
+
+
+@pytest.mark.parametrize('exclude', [
+    ['{src}/a.txt'],
+    ['sub'],
+    ['sub/b.txt'],
+    ['b.txt', '{src}/sub/nested'],
+])
+def test_excludes_match_gtar(tmp_path, src, exclude):
+    (src / 'sub' / 'nested').mkdir()
+    (src / 'sub' / 'nested' / 'b.txt').write_text('b')
+    exclude = [e.format(src=src) for e in exclude]
+    dest = str(tmp_path / 'out.tgz')
+    result = run_module(tmp_path, src=str(src), dest=dest, options='z', exclude=exclude)
+    assert '-T' in result['extract_results']['cmd']
+
+    expected = str(tmp_path / 'expected.tgz')
+    subprocess.check_call(['tar', '-czf', expected] + ['--exclude=' + e for e in exclude] + [str(src)],
+                          stderr=subprocess.DEVNULL)
+    assert archive_names(dest) == archive_names(expected)
+
+
+def test_wildcard_excludes_always_pack(tmp_path, src):
+    dest = str(tmp_path / 'out.tgz')
+    result = run_module(tmp_path, src=str(src), dest=dest, options='z', exclude=['*.txt'])
+    assert '--exclude=*.txt' in result['extract_results']['cmd']
+    assert not [name for name in archive_names(dest) if name.endswith('.txt')]
+    assert run_module(tmp_path, src=str(src), dest=dest, options='z', exclude=['*.txt'])['changed']
+
+
+@pytest.mark.skipif(os.geteuid() == 0, reason='root can read any directory')
+def test_unreadable_directory_fails(tmp_path, src):
+    (src / 'sub').chmod(0)
+    try:
+        result = run_module(tmp_path, src=str(src), dest=str(tmp_path / 'out.tgz'), options='z', exclude=['a.txt'])
+    finally:
+        (src / 'sub').chmod(0o755)
+    assert result['failed']
+
+
+def pigz_env(tmp_path, script):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    pigz = bin_dir / 'pigz'
+    pigz.write_text('#!/bin/sh\n%s\nexec %s "$@"\n' % (script, shutil.which('gzip')))
+    pigz.chmod(0o755)
+    return dict(os.environ, PATH='%s:%s' % (bin_dir, os.environ['PATH']))
+
+
+@pytest.mark.parametrize('script', [
+    '',
+    # More than a pipe buffer of stderr, which used to deadlock tar and pigz
+    'head -c 200000 /dev/zero | tr "\\0" x >&2',
+], ids=['quiet', 'noisy'])
+def test_parallel_compressor_pipeline(tmp_path, src, script):
+    env = pigz_env(tmp_path, script)
+    dest = str(tmp_path / 'out.tgz')
+    result = run_module(tmp_path, env=env, src=str(src), dest=dest, options='z')
+    assert result['changed'], result
+    assert result['extract_results']['cmd'][-2:] == ['|', str(tmp_path / 'bin' / 'pigz')]
+    assert [name for name in archive_names(dest) if name.endswith('sub/b.txt')]
+    assert not run_module(tmp_path, env=env, src=str(src), dest=dest, options='z')['changed']
+
+
+@pytest.mark.skipif(not shutil.which('zstd'), reason='needs zstd')
+def test_zstd(tmp_path, src):
+    dest = tmp_path / 'out.tar.zst'
+    result = run_module(tmp_path, src=str(src), dest=str(dest), options='zst')
+    assert result['handler'] == 'ZstdArchive'
+    assert dest.read_bytes()[:4] == b'\x28\xb5\x2f\xfd'
+    assert not run_module(tmp_path, src=str(src), dest=str(dest), options='zst')['changed']
+
+
+def test_zstd_missing_is_not_packed_as_gzip(tmp_path, src):
+    tar_dir = os.path.dirname(shutil.which('tar'))
+    env = dict(os.environ, PATH=tar_dir)
+    if shutil.which('zstd', path=tar_dir):
+        pytest.skip('zstd is installed next to tar')
+    result = run_module(tmp_path, env=env, src=str(src), dest=str(tmp_path / 'out.tar.zst'), options='zst')
+    assert result['failed']
+    assert 'Failed to find handler' in result['msg']
+    assert not (tmp_path / 'out.tar.zst').exists()